@@ -7,38 +7,58 @@ import hashlib
 import datetime
 import zipfile
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import io
 import warnings
 
+try:
+    from zlib_ng import zlib_ng
+except ImportError:
+    zlib_ng = None
+
 # 忽略不必要的警告
 warnings.filterwarnings("ignore")
 
+# zipfile通过模块级的zlib完成压缩，CRC计算则使用导入时绑定的crc32；
+# 安装了zlib-ng时将两者都替换为其兼容实现以加速。该替换对整个进程生效，
+# 进程内所有使用zipfile的代码（包括openpyxl读取xlsx）都会经过zlib-ng
+if zlib_ng is not None:
+    zipfile.zlib = zlib_ng
+    zipfile.crc32 = zlib_ng.crc32
+
+# J列JSON的常见格式：单个键、值为由不含转义的字符串或整数组成的非空数组
+# 空白字符仅限JSON允许的空格、制表符和换行，保证与json.loads结果一致
+SIMPLE_JSON_PATTERN = re.compile(
+    r'^[ \t\n\r]*\{[ \t\n\r]*"[^"\\\x00-\x1f]*"[ \t\n\r]*:[ \t\n\r]*\['
+    r'[ \t\n\r]*(?:"([^"\\\x00-\x1f]*)"|(0|-?[1-9][0-9]*))'
+    r'(?:[ \t\n\r]*,[ \t\n\r]*(?:"[^"\\\x00-\x1f]*"|0|-?[1-9][0-9]*))*'
+    r'[ \t\n\r]*\][ \t\n\r]*\}[ \t\n\r]*$'
+)
+
 # --- 核心处理函数 (与桌面版基本一致) ---
 
 def clean_cell_value(value):
     """清洗单元格值：处理空值、去空格，并为数字保留6位小数"""
-    if pd.isna(value) or value == '':
+    # 按dtype=str读取的单元格只会是字符串或空值，直接判断比逐个调用pd.isna更快
+    if value is None or value is pd.NA or (isinstance(value, float) and value != value):
         return ""
+    if isinstance(value, str):
+        return value.strip()
     return str(value).strip()
 
 def get_file_md5(file_path):
     """计算文件的MD5校验码（用于本地文件）"""
     if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
         return ""
-    md5_hash = hashlib.md5()
     with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, "md5").hexdigest()
+        # Python 3.11以下按1MB分块读取，减少调用次数
+        md5_hash = hashlib.md5()
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
             md5_hash.update(chunk)
     return md5_hash.hexdigest()
 
-def get_bytes_md5(bytes_data):
-    """计算字节流的MD5校验码（用于内存中的文件）"""
-    if not bytes_data:
-        return ""
-    md5_hash = hashlib.md5()
-    md5_hash.update(bytes_data)
-    return md5_hash.hexdigest()
-
 def read_task_info(df_task):
     """读取「任务说明」sheet，获取社会统一信用代码和数据日期"""
     if df_task.empty:
@@ -70,93 +90,210 @@ def read_business_info(df_business):
     if missing_cols:
         raise ValueError(f"「业务说明」sheet缺少必要列：{', '.join(missing_cols)}")
 
-    business_list = df_business[required_cols].drop_duplicates().to_dict("records")
+    # 一次遍历完成去重，保持首次出现的顺序
+    seen = set()
+    business_list = []
+    for name, en_name in zip(
+        df_business["业务表单名称"].fillna("").tolist(),
+        df_business["业务表单英文名称"].fillna("").tolist(),
+    ):
+        if (name, en_name) not in seen:
+            seen.add((name, en_name))
+            business_list.append({"业务表单名称": name, "业务表单英文名称": en_name})
     return business_list
 
-def process_business_data(excel_file, business, check_group, credit_code, data_date, logs):
-    """处理单个业务表单数据，生成DAT内容"""
+@st.cache_data(show_spinner=False, max_entries=2, ttl=3600)
+def load_excel_sheets(file_bytes):
+    """一次性读取Excel全部sheet，返回{sheet名称: DataFrame或读取失败的异常}
+
+    结果按文件内容缓存，重复处理同一文件时无需再次解析；缓存最多保留2个文件、1小时，
+    避免上传过的文件长期占用服务器内存。
+    优先使用calamine引擎解析；未安装python-calamine或pandas版本不支持该引擎时退回pandas默认引擎
+    （xlsx由openpyxl以只读模式加载）。
+    单个sheet读取失败不影响其他sheet，失败原因在使用该sheet时再抛出。
+    """
+    try:
+        excel_file = pd.ExcelFile(io.BytesIO(file_bytes), engine="calamine")
+    except (ImportError, ValueError):
+        # pandas 2.2以下不识别calamine引擎，会抛出ValueError
+        excel_file = pd.ExcelFile(io.BytesIO(file_bytes))
+    sheets = {}
+    for name in excel_file.sheet_names:
+        try:
+            sheets[name] = excel_file.parse(name, header=1, dtype=str)
+        except Exception as e:
+            # 只保留异常信息，保证缓存结果可序列化
+            sheets[name] = ValueError(str(e))
+    return sheets
+
+def get_sheet(sheets, sheet_name):
+    """从load_excel_sheets的结果中取出sheet，读取失败时抛出对应异常"""
+    df_sheet = sheets[sheet_name]
+    if isinstance(df_sheet, Exception):
+        raise df_sheet
+    return df_sheet
+
+def build_sample_index(df_sample, keys):
+    """清洗示例数据sheet中被引用的行，返回{C列值: D列及以后数据拼接串}（重复值取首行）"""
+    # 先清洗C列，只保留取值在keys中的首行，未被引用的行不做清洗
+    c_clean = df_sample.iloc[:, 2].fillna("").astype(str).str.strip()
+    df_sample = df_sample[(c_clean.isin(list(keys)) & ~c_clean.duplicated()).to_numpy()]
+    # 按列向量化清洗（空值置空、去空格），避免逐单元格调用clean_cell_value
+    cleaned = df_sample.fillna("").astype(str).apply(lambda col: col.str.strip())
+    sample_values = cleaned.to_numpy(dtype=object)
+    joined = ["@&@".join(row) for row in sample_values[:, 3:].tolist()]
+    return dict(zip(sample_values[:, 2].tolist(), joined))
+
+def parse_target_row_num(j_val):
+    """完整解析J列JSON，取首个键对应数组的第一个元素，返回(目标行号, 警告信息)"""
+    try:
+        json_obj = json.loads(j_val)
+        if not json_obj:
+            return None, "警告：JSON为空对象，跳过该行"
+        
+        json_key = list(json_obj.keys())[0]
+        json_value = json_obj[json_key]
+
+        if not isinstance(json_value, list) or len(json_value) == 0:
+            return None, "警告：JSON value不是非空数组，跳过该行"
+        
+        return str(json_value[0]).strip(), None
+    except json.JSONDecodeError:
+        return None, "警告：JSON解析失败，跳过该行"
+
+def process_business_data(sheets, business, df_check, form_to_rows, credit_code, data_date, logs):
+    """处理单个业务表单数据，生成DAT内容（字节）、MD5校验码及数据行数"""
     business_name = clean_cell_value(business["业务表单名称"])
     business_en_name = clean_cell_value(business["业务表单英文名称"])
     
     logs.append(f"\n--- 处理业务表单：{business_name}（英文名称：{business_en_name}）---")
 
-    dat_strings = []
+    dat_buf = bytearray()
+    md5_hash = hashlib.md5()
+    line_count = 0
     
     # 检查是否有匹配的校验结果
-    if check_group is None or business_name not in check_group.groups:
+    row_positions = form_to_rows.get(business_name) if form_to_rows else None
+    if not row_positions:
         logs.append(f"警告：无匹配的校验结果数据，生成空dat文件")
-        return dat_strings, business_en_name
+        return dat_buf, "", line_count, business_en_name
 
-    check_rows = check_group.get_group(business_name)
+    check_rows = df_check.iloc[row_positions]
     logs.append(f"找到{len(check_rows)}行匹配的校验结果数据")
 
-    for _, check_row in check_rows.iterrows():
+    # 常见的{"键": [值, ...]}格式按整列用正则提取首个元素，未匹配的行再逐行完整解析JSON
+    if check_rows.shape[1] > 9:
+        j_clean = check_rows.iloc[:, 9].fillna("").astype(str).str.strip()
+        extracted = j_clean.str.extract(SIMPLE_JSON_PATTERN.pattern)
+        target_keys = extracted[0].fillna(extracted[1]).str.strip().tolist()
+    else:
+        target_keys = [None] * len(check_rows)
+
+    # 只取C、G、I、J列转为Python列表后并行遍历，列数不足时末尾的列按空值处理
+    # 第一遍：生成第一段字符串并确定每行的目标行号
+    col_positions = [p for p in (2, 6, 8, 9) if p < check_rows.shape[1]]
+    check_values = check_rows.iloc[:, col_positions].to_numpy(dtype=object)
+    columns = [check_values[:, i].tolist() for i in range(len(col_positions))]
+    columns += [[""] * len(check_rows)] * (4 - len(col_positions))
+    c_list, g_list, i_list, j_list = columns
+    parsed_rows = []
+    for c_val, g_val, i_val, j_val, target_key in zip(c_list, g_list, i_list, j_list, target_keys):
         # 生成第一段字符串
-        c_val = clean_cell_value(check_row.iloc[2] if len(check_row) > 2 else "")
-        i_val = clean_cell_value(check_row.iloc[8] if len(check_row) > 8 else "")
-        g_val = clean_cell_value(check_row.iloc[6] if len(check_row) > 6 else "")
+        c_val = clean_cell_value(c_val)
+        i_val = clean_cell_value(i_val)
+        g_val = clean_cell_value(g_val)
         part1 = f"01|{c_val}|{i_val}|{g_val}|"
 
         # 处理J列JSON数据
-        j_val = clean_cell_value(check_row.iloc[9] if len(check_row) > 9 else "")
+        j_val = clean_cell_value(j_val)
         if not j_val:
-            logs.append(f"警告：J列无JSON数据，跳过该行")
-            continue
-        
+            parsed_rows.append((part1, None, "警告：J列无JSON数据，跳过该行"))
+        elif isinstance(target_key, str):
+            parsed_rows.append((part1, target_key, None))
+        else:
+            target_row_num, warning = parse_target_row_num(j_val)
+            parsed_rows.append((part1, target_row_num, warning))
+
+    # 读取示例数据sheet：没有任何行取到目标行号时不加载，否则只索引被引用的行
+    sample_sheet_name = f"示例数据_{business_name}"
+    needed_keys = {target for _, target, _ in parsed_rows if target is not None}
+    sheet_warning = None  # 示例数据sheet无可用数据，引用它的行均跳过
+    sample_error = None  # 读取失败，引用它的行只输出第一段
+    row_strings = {}
+    if needed_keys:
         try:
-            json_obj = json.loads(j_val)
-            if not json_obj:
-                logs.append(f"警告：JSON为空对象，跳过该行")
-                continue
-            
-            json_key = list(json_obj.keys())[0]
-            json_value = json_obj[json_key]
+            if sample_sheet_name not in sheets:
+                raise ValueError(f"未找到sheet「{sample_sheet_name}」")
+            df_sample = get_sheet(sheets, sample_sheet_name)
+            if df_sample.empty:
+                sheet_warning = "警告：示例数据sheet无有效数据"
+            elif len(df_sample.columns) < 3:
+                sheet_warning = "警告：示例数据sheet缺少C列"
+            else:
+                row_strings = build_sample_index(df_sample, needed_keys)
+        except Exception as e:
+            sample_error = e
 
-            if not isinstance(json_value, list) or len(json_value) == 0:
-                logs.append(f"警告：JSON value不是非空数组，跳过该行")
-                continue
-            
-            target_row_num = str(json_value[0]).strip()
-        except json.JSONDecodeError:
-            logs.append(f"警告：JSON解析失败，跳过该行")
+    # 第二遍：按原顺序拼接第二段字符串并写入DAT
+    for part1, target_row_num, warning in parsed_rows:
+        if warning:
+            logs.append(warning)
+            continue
+        if sheet_warning:
+            logs.append(sheet_warning)
             continue
 
-        # 读取示例数据sheet
-        sample_sheet_name = f"示例数据_{business_name}"
         part2 = ""
-        try:
-            df_sample = pd.read_excel(excel_file, sheet_name=sample_sheet_name, header=1, dtype=str)
-            if df_sample.empty:
-                logs.append(f"警告：示例数据sheet无有效数据")
-                continue
-            if len(df_sample.columns) < 3:
-                logs.append(f"警告：示例数据sheet缺少C列")
-                continue
-
-            # 清洗C列用于匹配
-            df_sample["C列_清洗后"] = df_sample.iloc[:, 2].apply(clean_cell_value)
-            matched_rows = df_sample[df_sample["C列_清洗后"] == target_row_num]
-
-            if matched_rows.empty:
+        if sample_error is not None:
+            logs.append(f"警告：读取示例数据失败 - {sample_error}")
+        else:
+            # 取D列及以后数据
+            part2 = row_strings.get(target_row_num)
+            if part2 is None:
                 logs.append(f"警告：示例数据sheet中未找到C列='{target_row_num}'的行")
                 continue
-            
-            # 删除临时列
-            matched_rows = matched_rows.drop(columns=["C列_清洗后"])
-            target_row = matched_rows.iloc[0]
-            
-            # 取D列及以后数据
-            d_after_data = target_row.iloc[3:] if len(target_row) > 3 else []
-            part2 = "@&@".join([clean_cell_value(val) for val in d_after_data])
-
-        except Exception as e:
-            logs.append(f"警告：读取示例数据失败 - {e}")
 
-        full_str = part1 + part2
-        dat_strings.append(full_str)
+        # 行间以换行分隔，末行不带换行；写入的同时累计MD5
+        line_bytes = (("\n" if line_count else "") + part1 + part2).encode("utf-8")
+        dat_buf += line_bytes
+        md5_hash.update(line_bytes)
+        line_count += 1
+    
+    logs.append(f"业务表单处理完成，共生成{line_count}行数据")
+    md5_value = md5_hash.hexdigest() if dat_buf else ""
+    return dat_buf, md5_value, line_count, business_en_name
+
+def build_business_zip(sheets, business, df_check, form_to_rows, credit_code, data_date):
+    """生成单个业务表单的ZIP包（含DAT和LOG文件），返回(ZIP文件名, ZIP字节, 处理日志)"""
+    logs = []
+    dat_bytes, md5_value, line_count, business_en_name = process_business_data(
+        sheets, business, df_check, form_to_rows, credit_code, data_date, logs
+    )
+    
+    # 生成LOG文件内容
+    base_filename = f"{credit_code}_{business_en_name}_CHK_{data_date}"
+    dat_filename = f"{base_filename}.dat"
     
-    logs.append(f"业务表单处理完成，共生成{len(dat_strings)}行数据")
-    return dat_strings, business_en_name
+    file_size = len(dat_bytes)
+    create_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    
+    log_content = "\n".join([
+        dat_filename,
+        md5_value,
+        str(file_size),
+        create_time,
+        str(line_count)
+    ])
+    log_bytes = log_content.encode("utf-8")
+    
+    # 生成单个ZIP文件
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zipf:
+        zipf.writestr(dat_filename, dat_bytes)
+        zipf.writestr(f"{base_filename}.log", log_bytes)
+    
+    logs.append(f"已生成ZIP文件：{base_filename}.zip")
+    return f"{base_filename}.zip", zip_buffer.getvalue(), logs
 
 # --- Streamlit 前端界面和主逻辑 ---
 
@@ -183,8 +320,8 @@ def main():
             
             try:
                 # 读取Excel文件
-                excel_file = pd.ExcelFile(uploaded_file)
-                sheet_names = excel_file.sheet_names
+                sheets = load_excel_sheets(uploaded_file.getvalue())
+                sheet_names = list(sheets)
                 logs.append(f"成功读取Excel文件，包含以下sheet: {', '.join(sheet_names)}")
 
                 # 检查必需sheet
@@ -194,13 +331,13 @@ def main():
                     raise ValueError(f"缺少必需的sheet: {', '.join(missing_required_sheets)}")
                 
                 # 读取任务说明
-                df_task = pd.read_excel(excel_file, sheet_name="任务说明", header=1, dtype=str)
+                df_task = get_sheet(sheets, "任务说明")
                 credit_code, data_date = read_task_info(df_task)
                 logs.append(f"社会统一信用代码：{credit_code}")
                 logs.append(f"数据日期：{data_date}")
 
                 # 读取业务说明
-                df_business = pd.read_excel(excel_file, sheet_name="业务说明", header=1, dtype=str)
+                df_business = get_sheet(sheets, "业务说明")
                 business_list = read_business_info(df_business)
                 if not business_list:
                     business_list = [{"业务表单名称": "默认表单", "业务表单英文名称": "Default"}]
@@ -208,63 +345,40 @@ def main():
 
                 # 读取校验结果
                 has_check_sheet = "校验结果" in sheet_names
-                check_group = None
+                df_check = None
+                form_to_rows = None
                 if has_check_sheet:
-                    df_check = pd.read_excel(excel_file, sheet_name="校验结果", header=1, dtype=str)
+                    df_check = get_sheet(sheets, "校验结果")
                     if "表单名称" in df_check.columns:
-                        check_group = df_check.groupby("表单名称", dropna=False) if not df_check.empty else None
+                        # 按表单名称记录行位置，替代groupby分组
+                        form_to_rows = defaultdict(list)
+                        for i, form_name in enumerate(df_check["表单名称"].tolist()):
+                            if not pd.isna(form_name):
+                                form_to_rows[form_name].append(i)
                         logs.append(f"「校验结果」sheet共{len(df_check)}行数据，已按表单名称分组")
                     else:
                         logs.append("警告：「校验结果」sheet缺少「表单名称」列")
 
-                # 处理所有业务表单
-                all_zip_bytes = []
-                for business in business_list:
-                    dat_strings, business_en_name = process_business_data(
-                        excel_file, business, check_group, credit_code, data_date, logs
-                    )
-                    
-                    # 生成DAT文件内容
-                    dat_content = "\n".join(dat_strings)
-                    dat_bytes = dat_content.encode("utf-8")
-                    
-                    # 生成LOG文件内容
-                    base_filename = f"{credit_code}_{business_en_name}_CHK_{data_date}"
-                    dat_filename = f"{base_filename}.dat"
-                    
-                    md5_value = get_bytes_md5(dat_bytes)
-                    file_size = len(dat_bytes)
-                    line_count = len([s for s in dat_strings if s.strip()])
-                    create_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    
-                    log_content = "\n".join([
-                        dat_filename,
-                        md5_value,
-                        str(file_size),
-                        create_time,
-                        str(line_count)
-                    ])
-                    log_bytes = log_content.encode("utf-8")
-                    
-                    # 生成单个ZIP文件
-                    zip_buffer = io.BytesIO()
-                    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
-                        zipf.writestr(dat_filename, dat_bytes)
-                        zipf.writestr(f"{base_filename}.log", log_bytes)
-                    
-                    zip_buffer.seek(0)
-                    all_zip_bytes.append((f"{base_filename}.zip", zip_buffer.getvalue()))
-                    
-                    logs.append(f"已生成ZIP文件：{base_filename}.zip")
-
-                # 生成总ZIP文件
+                # 处理所有业务表单：各业务互不依赖，用线程池并行生成（ZIP压缩时会释放GIL）
+                # 每个业务写入独立日志列表，按原顺序合并；生成的ZIP随即写入总ZIP，不再整体保留
+                # 总ZIP文件内层ZIP已压缩，外层仅存储不再重复压缩
                 total_zip_buffer = io.BytesIO()
-                with zipfile.ZipFile(total_zip_buffer, "w", zipfile.ZIP_DEFLATED) as total_zipf:
-                    for zip_name, zip_data in all_zip_bytes:
+                zip_count = 0
+                with ThreadPoolExecutor(max_workers=min(8, len(business_list))) as executor, \
+                        zipfile.ZipFile(total_zip_buffer, "w", zipfile.ZIP_STORED) as total_zipf:
+                    results = executor.map(
+                        lambda business: build_business_zip(
+                            sheets, business, df_check, form_to_rows, credit_code, data_date
+                        ),
+                        business_list,
+                    )
+                    for zip_name, zip_data, business_logs in results:
                         total_zipf.writestr(zip_name, zip_data)
+                        logs.extend(business_logs)
+                        zip_count += 1
                 
                 total_zip_buffer.seek(0)
-                logs.append(f"\n✅ 所有文件处理完成！共生成{len(all_zip_bytes)}个ZIP包")
+                logs.append(f"\n✅ 所有文件处理完成！共生成{zip_count}个ZIP包")
                 
                 # 显示日志和下载按钮
                 log_placeholder.markdown("### 处理日志\n" + "\n".join([f"> {log}" for log in logs]))